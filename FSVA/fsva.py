@@ -1,135 +1,1052 @@
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+from itertools import combinations, product
+import mmap
+from multiprocessing import get_context, shared_memory
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from tqdm import tqdm
 
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:  # Numba 為選用套件，未安裝時使用 NumPy 位元平面實作
+    njit = None
+
+try:
+    from numba import cuda, uint64
+    if not cuda.is_available():
+        cuda = None
+except ImportError:  # numba.cuda 需要 Numba 與可用的 GPU，否則使用 CPU 實作
+    cuda = None
+
+try:
+    import parasail
+except ImportError:  # parasail 為選用套件，未安裝時使用 NumPy 反對角線實作
+    parasail = None
+
+# Cython 核心較 Numba 的字組掃描慢，只在沒有 Numba 時才編譯與匯入
+scan_matches = None
+if njit is None:
+    try:
+        import pyximport
+        pyximport_hooks = pyximport.install(language_level=3)
+        try:
+            from tcam_scan import scan_matches
+        finally:
+            # import hook 只用於編譯 tcam_scan，匯入後即移除，不影響其他模組
+            pyximport.uninstall(*pyximport_hooks)
+    except ImportError:  # Cython 為選用套件，未安裝或無法編譯時使用其他實作
+        scan_matches = None
+
+# TCAM 鹼基編碼：每個鹼基以 one-hot 的 4-bit 編碼表示，N 為萬用字元 (全 1)
+# 兩個編碼的 AND 不為 0 即視為匹配，萬用字元因此可與任意鹼基匹配
+base_encoding = {'A': 0x1, 'C': 0x2, 'T': 0x4, 'G': 0x8, 'N': 0xF}
+WILDCARD_CODE = base_encoding['N']
+# IUPAC 模糊鹼基代表多種可能的鹼基，位元平面只能表示單一鹼基或萬用字元，因此一律編碼為萬用字元
+AMBIGUITY_CODES = 'RYSWKMBDHV'
+# 256 項查表，小寫 (soft-masked) 鹼基與大寫相同；其他未定義的字元編碼為 0，由 encode_sequence 拒絕
+ENCODING_TABLE = bytes(base_encoding.get(chr(i).upper(), WILDCARD_CODE if chr(i).upper() in AMBIGUITY_CODES else 0)
+                       for i in range(256))
+ENCODING_LOOKUP = np.frombuffer(ENCODING_TABLE, dtype=np.uint8)
+# 比對前將 ASCII 小寫轉為大寫的查表
+UPPERCASE_LOOKUP = np.frombuffer(bytes(range(256)).upper(), dtype=np.uint8)
+
+
+def encode_sequence(sequence):
+    """
+    以查表方式將鹼基序列編碼為 TCAM 編碼，整段序列只需一次 C 層級的轉換。
+    接受 ACGTN 與 IUPAC 模糊鹼基 (大小寫皆可)，模糊鹼基視為萬用字元，其他字元則拒絕。
+    :param sequence: 鹼基序列，可為字串或 bytes、memoryview、mmap 等 ASCII 緩衝區 (string or bytes-like)
+    :return: 每個鹼基一個位元組的編碼結果 (numpy.ndarray(dtype=uint8))
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii')
+    if isinstance(sequence, bytes):
+        encoded = np.frombuffer(sequence.translate(ENCODING_TABLE), dtype=np.uint8)
+    else:
+        # 其他緩衝區直接以 numpy 檢視後查表，不先複製成 bytes
+        encoded = ENCODING_LOOKUP[np.frombuffer(sequence, dtype=np.uint8)]
+    # 所有實作對未定義字元採相同處理：一律拒絕
+    if not encoded.all():
+        raise ValueError("Sequence contains unsupported bases.")
+    return encoded
+
+
+def match_with_wildcard(a, b):
+    """
+    判斷已編碼的鹼基是否匹配，參數可互相 broadcast。
+    :param a: 已編碼的鹼基 (numpy.ndarray(dtype=uint8))
+    :param b: 已編碼的鹼基 (numpy.ndarray(dtype=uint8))
+    :return: 是否匹配 (numpy.ndarray(dtype=bool))
+    """
+    return np.bitwise_and(a, b) != 0
+
+
+# 位元平面：每個鹼基佔 2 bits，val 平面記錄鹼基值，mask 平面在萬用字元處為 11
+# 一個 uint64 最多容納 32 個鹼基
+PLANE_BASES = 32
+VALUE_PLANE = np.zeros(256, dtype=np.uint64)
+MASK_PLANE = np.zeros(256, dtype=np.uint64)
+VALID_CODE = np.zeros(256, dtype=bool)
+for _value, _base in enumerate('ACGT'):
+    VALUE_PLANE[base_encoding[_base]] = _value
+    VALID_CODE[base_encoding[_base]] = True
+MASK_PLANE[WILDCARD_CODE] = 0b11
+VALID_CODE[WILDCARD_CODE] = True
+
+LOW_BITS = np.uint64(0x5555555555555555)
+# 二維比對時每段暫存陣列的元素數上限
+CHUNK_ELEMENTS = 1 << 22
+# Cython 與 CUDA 掃描輸出緩衝區的初始長度，不足時再擴充
+MATCH_BUFFER_SIZE = 1 << 16
+# CUDA 每個區塊的執行緒數，以及每個區塊快取於共享記憶體的種子數
+CUDA_THREADS = 256
+CUDA_SEED_TILE = 32
+
+# Smith-Waterman 計分：匹配 +2、不匹配 -1、線性 gap 每個位置 -1
+MATCH_SCORE = 2
+MISMATCH_SCORE = -1
+GAP_PENALTY = 1
+# parasail 對字母表以外的字元一律給 0 分，字母表因此涵蓋 encode_sequence 接受的所有字元，與其他實作的計分一致
+SCORE_ALPHABET = 'ACGTN' + AMBIGUITY_CODES
+SCORE_MATRIX = parasail.matrix_create(SCORE_ALPHABET, MATCH_SCORE, MISMATCH_SCORE) if parasail is not None else None
+
+
+def pack_bit_planes(encoded, seed_length):
+    """
+    將已編碼序列中每個長度為 seed_length 的視窗打包為 val 與 mask 兩個位元平面。
+    :param encoded: 已編碼的序列 (numpy.ndarray(dtype=uint8))
+    :param seed_length: 視窗長度，最多 32 (int)
+    :return: 起始位置 i 的視窗對應第 i 項 (tuple of numpy.ndarray(dtype=uint64))
+    """
+    if not 0 < seed_length <= PLANE_BASES:
+        raise ValueError(f"seed_length must be between 1 and {PLANE_BASES}.")
+    if not VALID_CODE[encoded].all():
+        raise ValueError("Sequence contains unsupported bases.")
+
+    base_val = VALUE_PLANE[encoded]
+    base_mask = MASK_PLANE[encoded]
+    n_windows = max(len(encoded) - seed_length + 1, 0)
+    val = np.zeros(n_windows, dtype=np.uint64)
+    mask = np.zeros(n_windows, dtype=np.uint64)
+    # 以位移疊加的方式一次建構所有視窗，迴圈次數只與 seed_length 有關
+    for j in range(seed_length):
+        val <<= np.uint64(2)
+        val |= base_val[j:j + n_windows]
+        mask <<= np.uint64(2)
+        mask |= base_mask[j:j + n_windows]
+    return val, mask
+
+
+def pack_sequence(encoded):
+    """
+    將已編碼序列緊密打包為 val 與 mask 位元平面，每個 uint64 依序存放 32 個鹼基 (高位在前)。
+    末端補上一個全 0 的字組，讓跨字組的視窗不必檢查邊界。
+    :param encoded: 已編碼的序列 (numpy.ndarray(dtype=uint8))
+    :return: val 與 mask 字組陣列 (tuple of numpy.ndarray(dtype=uint64))
+    """
+    if not VALID_CODE[encoded].all():
+        raise ValueError("Sequence contains unsupported bases.")
+
+    n_words = (len(encoded) + PLANE_BASES - 1) // PLANE_BASES + 1
+    shifts = np.arange(2 * (PLANE_BASES - 1), -1, -2, dtype=np.uint64)
+    planes = []
+    for table in (VALUE_PLANE, MASK_PLANE):
+        bases = np.zeros(n_words * PLANE_BASES, dtype=np.uint64)
+        bases[:len(encoded)] = table[encoded]
+        planes.append(np.bitwise_or.reduce(bases.reshape(n_words, PLANE_BASES) << shifts, axis=1))
+    return planes[0], planes[1]
+
+
+def popcount64(x):
+    """
+    以 SWAR 方式計算每個 uint64 的位元數。
+    :param x: 輸入陣列 (numpy.ndarray(dtype=uint64))
+    :return: 每項的位元數 (numpy.ndarray(dtype=uint64))
+    """
+    x = x - ((x >> np.uint64(1)) & LOW_BITS)
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def pack_seeds(seeds):
+    """
+    將種子打包為 val 與 mask 位元平面。
+    :param seeds: 已編碼的種子 (numpy.ndarray(dtype=uint8), shape=(n_seeds, seed_length))
+    :return: 每個種子的 val 與 mask 位元平面 (tuple of numpy.ndarray(dtype=uint64))
+    """
+    if not VALID_CODE[seeds].all():
+        raise ValueError("Sequence contains unsupported bases.")
+    shifts = np.arange(2 * (seeds.shape[1] - 1), -1, -2, dtype=np.uint64)
+    seed_vals = np.bitwise_or.reduce(VALUE_PLANE[seeds] << shifts, axis=1)
+    seed_masks = np.bitwise_or.reduce(MASK_PLANE[seeds] << shifts, axis=1)
+    return seed_vals, seed_masks
+
+
+def plane_distance(seed_val, seed_mask, reference_val, reference_mask):
+    """
+    以位元平面計算種子與參考視窗的 Hamming 距離，萬用字元 N 可與任意鹼基匹配，參數可互相 broadcast。
+    :param seed_val: 種子的 val 位元平面 (numpy.uint64 或 numpy.ndarray(dtype=uint64))
+    :param seed_mask: 種子的 mask 位元平面 (numpy.uint64 或 numpy.ndarray(dtype=uint64))
+    :param reference_val: 參考視窗的 val 位元平面 (numpy.ndarray(dtype=uint64))
+    :param reference_mask: 參考視窗的 mask 位元平面 (numpy.ndarray(dtype=uint64))
+    :return: 不匹配的鹼基數 (numpy.ndarray(dtype=uint64))
+    """
+    diff = np.bitwise_and(np.bitwise_xor(reference_val, seed_val), ~(reference_mask | seed_mask))
+    # 每個鹼基的 2 bits 合併為 1 bit，位元數即為不匹配的鹼基數
+    diff = (diff | (diff >> np.uint64(1))) & LOW_BITS
+    return popcount64(diff)
+
+
+def tcam_lookup(seed_val, seed_mask, reference_val, reference_mask, max_hamming_distance):
+    """
+    模擬 TCAM 查找過程，支持近似匹配，萬用字元 N 可與任意鹼基匹配。
+    每個視窗只需數個 uint64 位元運算即可得到 Hamming 距離。
+    :param seed_val: 種子的 val 位元平面 (numpy.uint64)
+    :param seed_mask: 種子的 mask 位元平面 (numpy.uint64)
+    :param reference_val: 參考基因組所有視窗的 val 位元平面 (numpy.ndarray(dtype=uint64))
+    :param reference_mask: 參考基因組所有視窗的 mask 位元平面 (numpy.ndarray(dtype=uint64))
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :return: 匹配位置陣列 (numpy.ndarray(dtype=int64))
+    """
+    distance = plane_distance(seed_val, seed_mask, reference_val, reference_mask)
+    return np.flatnonzero(distance <= max_hamming_distance)
+
+
+def tcam_lookup_all(seed_vals, seed_masks, reference_val, reference_mask, max_hamming_distance):
+    """
+    以二維 broadcast 一次比對所有種子與所有參考視窗，參考基因組分段處理以限制暫存陣列的大小。
+    :param seed_vals: 所有種子的 val 位元平面 (numpy.ndarray(dtype=uint64))
+    :param seed_masks: 所有種子的 mask 位元平面 (numpy.ndarray(dtype=uint64))
+    :param reference_val: 參考基因組所有視窗的 val 位元平面 (numpy.ndarray(dtype=uint64))
+    :param reference_mask: 參考基因組所有視窗的 mask 位元平面 (numpy.ndarray(dtype=uint64))
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :return: 每個匹配的種子索引與位置 (tuple of numpy.ndarray(dtype=int64))
+    """
+    chunk = max(CHUNK_ELEMENTS // max(len(seed_vals), 1), 1)
+    seed_ids, positions = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(reference_val), chunk):
+        distance = plane_distance(seed_vals[:, None], seed_masks[:, None],
+                                  reference_val[None, start:start + chunk],
+                                  reference_mask[None, start:start + chunk])
+        ids, windows = np.nonzero(distance <= max_hamming_distance)
+        seed_ids.append(ids)
+        positions.append(windows + start)
+    return np.concatenate(seed_ids), np.concatenate(positions)
+
+
+# make_scan 依種子長度產生的專用掃描函式
+SCANNERS = {}
+
+
+def make_scan(seed_length):
+    """
+    為固定的種子長度產生 Numba 編譯的 TCAM 查找，種子長度成為編譯期常數，視窗擷取的位移可直接展開。
+    同一種子長度在每個行程中只編譯一次，結果保存在 SCANNERS。
+    :param seed_length: 種子長度，最多 32 (int)
+    :return: 掃描函式，參數為 (參考 val 字組, 參考 mask 字組, 參考基因組長度, 種子 val, 種子 mask, 最大 Hamming 距離) (function)
+    """
+    if seed_length in SCANNERS:
+        return SCANNERS[seed_length]
+    tail = np.uint64(64 - 2 * seed_length)
+
+    # 閉包函式的磁碟快取會在不同種子長度之間誤用已編譯的版本，因此不使用 cache
+    @njit(parallel=True)
+    def hamming_scan(reference_val_words, reference_mask_words, reference_length,
+                     seed_val, seed_mask, max_hamming_distance):
+        """
+        以 Numba 編譯的 TCAM 查找：直接在緊密打包的參考字組上滑動，逐視窗計算 XOR 與 popcount。
+        :param reference_val_words: 參考基因組的 val 字組 (numpy.ndarray(dtype=uint64))
+        :param reference_mask_words: 參考基因組的 mask 字組 (numpy.ndarray(dtype=uint64))
+        :param reference_length: 參考基因組長度 (int)
+        :param seed_val: 種子的 val 位元平面 (numpy.uint64)
+        :param seed_mask: 種子的 mask 位元平面 (numpy.uint64)
+        :param max_hamming_distance: 最大 Hamming 距離 (int)
+        :return: 匹配位置陣列 (numpy.ndarray(dtype=int64))
+        """
+        n_windows = max(reference_length - seed_length + 1, 0)
+        hits = np.zeros(n_windows, dtype=np.bool_)
+        low_bits = np.uint64(0x5555555555555555)
+        for i in prange(n_windows):
+            word = i // 32
+            offset = np.uint64(2 * (i % 32))
+            window_val = reference_val_words[word] << offset
+            window_mask = reference_mask_words[word] << offset
+            if offset:
+                window_val |= reference_val_words[word + 1] >> (np.uint64(64) - offset)
+                window_mask |= reference_mask_words[word + 1] >> (np.uint64(64) - offset)
+            window_val >>= tail
+            window_mask >>= tail
+
+            diff = (window_val ^ seed_val) & ~(window_mask | seed_mask)
+            diff = (diff | (diff >> np.uint64(1))) & low_bits
+            # SWAR popcount，LLVM 會將其辨識為硬體 popcnt 指令
+            diff = (diff & np.uint64(0x3333333333333333)) + ((diff >> np.uint64(2)) & np.uint64(0x3333333333333333))
+            diff = (diff + (diff >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+            mismatches = (diff * np.uint64(0x0101010101010101)) >> np.uint64(56)
+            hits[i] = mismatches <= max_hamming_distance
+        return np.flatnonzero(hits)
+
+    SCANNERS[seed_length] = hamming_scan
+    return hamming_scan
+
+
+def packed_lookup(seed_val, seed_mask, reference_val_words, reference_mask_words, reference_length, seed_length,
+                  max_hamming_distance):
+    """
+    在 pack_sequence 的緊密字組上查找單一種子，有 Numba 時使用 make_scan，否則分段以 NumPy 取出視窗再比對。
+    :param seed_val: 種子的 val 位元平面 (numpy.uint64)
+    :param seed_mask: 種子的 mask 位元平面 (numpy.uint64)
+    :param reference_val_words: 參考基因組的 val 字組 (numpy.ndarray(dtype=uint64))
+    :param reference_mask_words: 參考基因組的 mask 字組 (numpy.ndarray(dtype=uint64))
+    :param reference_length: 參考基因組長度 (int)
+    :param seed_length: 種子長度，最多 32 (int)
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :return: 匹配位置陣列 (numpy.ndarray(dtype=int64))
+    """
+    if njit is not None:
+        return make_scan(seed_length)(reference_val_words, reference_mask_words, reference_length,
+                                      seed_val, seed_mask, max_hamming_distance)
+    n_windows = max(reference_length - seed_length + 1, 0)
+    tail = np.uint64(64 - 2 * seed_length)
+    matches = [np.empty(0, dtype=np.int64)]
+    for start in range(0, n_windows, CHUNK_ELEMENTS):
+        windows = np.arange(start, min(start + CHUNK_ELEMENTS, n_windows))
+        word = windows // PLANE_BASES
+        offset = (2 * (windows % PLANE_BASES)).astype(np.uint64)
+        planes = []
+        for words in (reference_val_words, reference_mask_words):
+            # 下一個字組先右移 1 位再移 63 - offset 位，offset 為 0 時結果為 0，不需移位 64 位
+            window = (words[word] << offset) | ((words[word + 1] >> np.uint64(1)) >> (np.uint64(63) - offset))
+            planes.append(window >> tail)
+        matches.append(tcam_lookup(seed_val, seed_mask, *planes, max_hamming_distance) + start)
+    return np.concatenate(matches)
+
+
+if cuda is not None:
+    @cuda.jit
+    def hamming_scan_kernel(reference_val_words, reference_mask_words, n_windows, seed_vals, seed_masks,
+                            seed_length, max_hamming_distance, out_seed_ids, out_positions, out_count):
+        """
+        CUDA 版 TCAM 查找：每個執行緒負責一個參考視窗，與區塊內快取於共享記憶體的一批種子比對。
+        匹配以 atomic 計數取得寫入位置，超出輸出緩衝區的部分只計數不寫入。
+        """
+        tile_val = cuda.shared.array(CUDA_SEED_TILE, dtype=uint64)
+        tile_mask = cuda.shared.array(CUDA_SEED_TILE, dtype=uint64)
+        first = cuda.blockIdx.y * CUDA_SEED_TILE
+        n_tile = min(CUDA_SEED_TILE, seed_vals.shape[0] - first)
+        if cuda.threadIdx.x < n_tile:
+            tile_val[cuda.threadIdx.x] = seed_vals[first + cuda.threadIdx.x]
+            tile_mask[cuda.threadIdx.x] = seed_masks[first + cuda.threadIdx.x]
+        cuda.syncthreads()
+
+        i = cuda.grid(1)
+        if i >= n_windows:
+            return
+        word = i // 32
+        offset = np.uint64(2 * (i % 32))
+        window_val = reference_val_words[word] << offset
+        window_mask = reference_mask_words[word] << offset
+        if offset:
+            window_val |= reference_val_words[word + 1] >> (np.uint64(64) - offset)
+            window_mask |= reference_mask_words[word + 1] >> (np.uint64(64) - offset)
+        tail = np.uint64(64 - 2 * seed_length)
+        window_val >>= tail
+        window_mask >>= tail
+
+        for s in range(n_tile):
+            diff = (window_val ^ tile_val[s]) & ~(window_mask | tile_mask[s])
+            diff = (diff | (diff >> np.uint64(1))) & np.uint64(0x5555555555555555)
+            if cuda.popc(diff) <= max_hamming_distance:
+                slot = cuda.atomic.add(out_count, 0, 1)
+                if slot < out_positions.shape[0]:
+                    out_seed_ids[slot] = first + s
+                    out_positions[slot] = i
+
+
+def cuda_lookup_all(seed_vals, seed_masks, reference_val_words, reference_mask_words, reference_length,
+                    match_buffers, seed_length, max_hamming_distance):
+    """
+    在 GPU 上一次比對所有種子，參考字組與輸出緩衝區已由 pack_scan_reference 配置於裝置端。
+    輸出緩衝區不足時加倍擴充並再執行一次，擴充後的緩衝區保留在 match_buffers 供之後的讀取沿用。
+    :param seed_vals: 所有種子的 val 位元平面 (numpy.ndarray(dtype=uint64))
+    :param seed_masks: 所有種子的 mask 位元平面 (numpy.ndarray(dtype=uint64))
+    :param reference_val_words: 裝置端的參考基因組 val 字組 (numba.cuda.DeviceNDArray(dtype=uint64))
+    :param reference_mask_words: 裝置端的參考基因組 mask 字組 (numba.cuda.DeviceNDArray(dtype=uint64))
+    :param reference_length: 參考基因組長度 (int)
+    :param match_buffers: 裝置端的種子索引與位置輸出緩衝區，擴充時就地替換 (list of numba.cuda.DeviceNDArray(dtype=int64))
+    :param seed_length: 種子長度，最多 32 (int)
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :return: 每個匹配的種子索引與位置 (tuple of numpy.ndarray(dtype=int64))
+    """
+    n_windows = max(reference_length - seed_length + 1, 0)
+    if n_windows == 0 or len(seed_vals) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    blocks = ((n_windows + CUDA_THREADS - 1) // CUDA_THREADS, (len(seed_vals) + CUDA_SEED_TILE - 1) // CUDA_SEED_TILE)
+    device_vals, device_masks = cuda.to_device(seed_vals), cuda.to_device(seed_masks)
+    while True:
+        out_seed_ids, out_positions = match_buffers
+        out_count = cuda.to_device(np.zeros(1, dtype=np.int64))
+        hamming_scan_kernel[blocks, CUDA_THREADS](reference_val_words, reference_mask_words, n_windows,
+                                                  device_vals, device_masks, seed_length, max_hamming_distance,
+                                                  out_seed_ids, out_positions, out_count)
+        count = int(out_count.copy_to_host()[0])
+        if count <= len(out_positions):
+            break
+        capacity = max(count, 2 * len(out_positions))
+        match_buffers[:] = [cuda.device_array(capacity, dtype=np.int64), cuda.device_array(capacity, dtype=np.int64)]
+    seed_ids = out_seed_ids[:count].copy_to_host()
+    positions = out_positions[:count].copy_to_host()
+    # atomic 寫入的順序不固定，排序後與 CPU 實作一致
+    order = np.lexsort((positions, seed_ids))
+    return seed_ids[order], positions[order]
+
+
+def tcam_lookup_bytes_all(seeds, reference_windows, max_hamming_distance):
+    """
+    以位元組視窗一次比對所有種子，供超過 32 個鹼基、無法放入單一 uint64 的長種子使用。
+    參考視窗分段處理，每段的暫存陣列為 (種子數, 視窗數, seed_length) 個位元組。
+    :param seeds: 所有已編碼的種子 (numpy.ndarray(dtype=uint8), shape=(n_seeds, seed_length))
+    :param reference_windows: 參考基因組的滑動視窗 (numpy.ndarray(dtype=uint8), shape=(n, seed_length))
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :return: 每個匹配的種子索引與位置 (tuple of numpy.ndarray(dtype=int64))
+    """
+    chunk = max(CHUNK_ELEMENTS // max(seeds.size, 1), 1)
+    seed_ids, positions = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(reference_windows), chunk):
+        windows = reference_windows[None, start:start + chunk]
+        mismatches = ~match_with_wildcard(seeds[:, None, :], windows)
+        ids, hits = np.nonzero(mismatches.sum(axis=-1) <= max_hamming_distance)
+        seed_ids.append(ids)
+        positions.append(hits + start)
+    return np.concatenate(seed_ids), np.concatenate(positions)
+
+
+def pack_reference(reference, seed_length):
+    """
+    將已編碼的參考基因組打包一次，之後所有讀取與種子的查找都共用同一份緩衝區。
+    :param reference: 已編碼的參考基因組 (numpy.ndarray(dtype=uint8))
+    :param seed_length: 種子長度 (int)
+    :return: 依實作而定的打包結果，僅有 Cython 時為位元組陣列，其餘見 pack_scan_reference (tuple)
+    """
+    # Cython 核心為單執行緒的逐位元組比對，只在沒有 Numba 時匯入
+    if scan_matches is not None:
+        return (reference,)
+    return pack_scan_reference(reference, seed_length)
+
+
+def pack_scan_reference(reference, seed_length):
+    """
+    為 scan_seeds 打包參考基因組。
+    :param reference: 已編碼的參考基因組 (numpy.ndarray(dtype=uint8))
+    :param seed_length: 種子長度 (int)
+    :return: CUDA 為裝置端緊密字組與輸出緩衝區、Numba 為緊密字組、NumPy 為視窗位元平面、長種子為位元組視窗 (tuple)
+    """
+    if seed_length <= PLANE_BASES and cuda is not None:
+        # 參考基因組只複製到 GPU 一次，之後所有種子共用；輸出緩衝區也隨之保留，擴充後的容量可供之後的讀取沿用
+        reference_val_words, reference_mask_words = pack_sequence(reference)
+        match_buffers = [cuda.device_array(MATCH_BUFFER_SIZE, dtype=np.int64),
+                         cuda.device_array(MATCH_BUFFER_SIZE, dtype=np.int64)]
+        return (cuda.to_device(reference_val_words), cuda.to_device(reference_mask_words), len(reference),
+                match_buffers)
+    if seed_length <= PLANE_BASES and njit is not None:
+        reference_val_words, reference_mask_words = pack_sequence(reference)
+        return reference_val_words, reference_mask_words, len(reference)
+    if seed_length <= PLANE_BASES:
+        return pack_bit_planes(reference, seed_length)
+    # 視窗僅為參考基因組的 view，不會複製資料
+    return (sliding_window_view(reference, seed_length),)
+
+
+def build_seed_index(reference, seed_length):
+    """
+    一次掃描參考基因組並建立 k-mer 索引，精確匹配的種子只需一次字典查詢。
+    含萬用字元的視窗無法以單一鍵值表示，另外記錄其位置與位元平面，查詢時再逐一比對；
+    含萬用字元的種子則以緊密打包的參考字組掃描，不保留所有視窗的位元平面。
+    :param reference: 已編碼的參考基因組 (numpy.ndarray(dtype=uint8))
+    :param seed_length: 種子長度，最多 32 (int)
+    :return: (k-mer 鍵值 -> 位置陣列的字典, 含萬用字元的視窗位置, 其 val 位元平面, 其 mask 位元平面,
+             參考基因組的 val 字組, 參考基因組的 mask 字組, 參考基因組長度, 建立索引時的種子長度) (tuple)
+    """
+    reference_val, reference_mask = pack_bit_planes(reference, seed_length)
+    # 參考基因組長度在 int32 範圍內時，位置以 int32 儲存
+    position_dtype = np.int32 if len(reference) <= np.iinfo(np.int32).max else np.int64
+    exact = np.flatnonzero(reference_mask == 0)
+    # 依鍵值穩定排序後切段，每個鍵值的位置維持遞增
+    order = exact[np.argsort(reference_val[exact], kind='stable')]
+    keys, starts = np.unique(reference_val[order], return_index=True)
+    index = dict(zip(keys.tolist(), np.split(order.astype(position_dtype), starts[1:])))
+    # 含萬用字元的視窗在每次查詢都要比對，其位元平面只在此取出一次
+    wildcard_positions = np.flatnonzero(reference_mask)
+    wildcard_val, wildcard_mask = reference_val[wildcard_positions], reference_mask[wildcard_positions]
+    reference_val_words, reference_mask_words = pack_sequence(reference)
+    return (index, wildcard_positions.astype(position_dtype), wildcard_val, wildcard_mask,
+            reference_val_words, reference_mask_words, len(reference), seed_length)
+
+
+# neighbor_deltas 依 (種子長度, 最大 Hamming 距離) 列舉的鄰居差值
+NEIGHBOR_DELTAS = {}
+
+
+def neighbor_deltas(seed_length, max_hamming_distance):
+    """
+    列舉 Hamming 距離不超過門檻的所有鄰居種子，以與原種子 XOR 的差值表示。
+    同一組參數在每個行程中只列舉一次，結果保存在 NEIGHBOR_DELTAS，之後的讀取直接沿用。
+    :param seed_length: 種子長度 (int)
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :return: 唯讀的差值陣列，第一項為 0 (即原種子) (numpy.ndarray(dtype=uint64))
+    """
+    key = (seed_length, max_hamming_distance)
+    if key in NEIGHBOR_DELTAS:
+        return NEIGHBOR_DELTAS[key]
+    deltas = [0]
+    for distance in range(1, min(max_hamming_distance, seed_length) + 1):
+        for positions in combinations(range(seed_length), distance):
+            shifts = [2 * (seed_length - 1 - position) for position in positions]
+            # 每個位置可替換為另外三種鹼基
+            for substitutions in product((1, 2, 3), repeat=distance):
+                deltas.append(sum(value << shift for value, shift in zip(substitutions, shifts)))
+    deltas = np.array(deltas, dtype=np.uint64)
+    # 所有讀取共用同一份陣列，設為唯讀以免被就地修改
+    deltas.flags.writeable = False
+    NEIGHBOR_DELTAS[key] = deltas
+    return deltas
+
+
+def index_lookup(seed_val, seed_mask, seed_index, deltas, max_hamming_distance):
+    """
+    以 k-mer 索引查找種子的近似匹配位置。
+    :param seed_val: 種子的 val 位元平面 (numpy.uint64)
+    :param seed_mask: 種子的 mask 位元平面 (numpy.uint64)
+    :param seed_index: build_seed_index 建立的索引 (tuple)
+    :param deltas: neighbor_deltas 列舉的鄰居差值 (numpy.ndarray(dtype=uint64))
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :return: 匹配位置陣列，依位置遞增排列 (numpy.ndarray(dtype=int32 或 int64))
+    """
+    (index, wildcard_positions, wildcard_val, wildcard_mask,
+     reference_val_words, reference_mask_words, reference_length, seed_length) = seed_index
+    if seed_mask:
+        # 含萬用字元的種子無法列舉鍵值，直接在緊密字組上比對所有視窗
+        return packed_lookup(seed_val, seed_mask, reference_val_words, reference_mask_words, reference_length,
+                             seed_length, max_hamming_distance)
+
+    empty = np.empty(0, dtype=np.int64)
+    hits = [index.get(key, empty) for key in (deltas ^ seed_val).tolist()]
+    wildcard_hits = tcam_lookup(seed_val, seed_mask, wildcard_val, wildcard_mask, max_hamming_distance)
+    hits.append(wildcard_positions[wildcard_hits])
+    return np.sort(np.concatenate(hits))
+
+
 def generate_seeds(read, seed_length):
     """
-    將讀取序列分解為固定長度的種子。
-    :param read: 待處理的基因讀取數據 (string)
+    將讀取序列分解為固定長度的種子，相同的種子只保留一份，並以 CSR 形式記錄其在讀取中出現的位移。
+    :param read: 已編碼的基因讀取數據 (numpy.ndarray(dtype=uint8))
+    :param seed_length: 種子長度 (int)
+    :return: 不重複的種子 (numpy.ndarray(dtype=uint8), shape=(n_seeds, seed_length))、
+             第 s 個種子的位移為 offsets[offset_ptr[s]:offset_ptr[s + 1]] 的 offset_ptr 與 offsets
+             (tuple of numpy.ndarray)
+    """
+    if len(read) < seed_length:
+        return np.empty((0, seed_length), dtype=np.uint8), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64)
+    windows = sliding_window_view(read, seed_length)
+    seeds, seed_ids, counts = np.unique(windows, axis=0, return_inverse=True, return_counts=True)
+    # 依種子穩定排序位移，同一種子的位移維持遞增
+    offsets = np.argsort(seed_ids.ravel(), kind='stable').astype(np.int64)
+    offset_ptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    return seeds, offset_ptr, offsets
+
+
+def scan_seeds(seeds, packed_reference, seed_length, max_hamming_distance, seed_index=None):
+    """
+    對不重複的種子執行 TCAM 查找，依種子長度與可用套件選擇實作。
+    :param seeds: 不重複的已編碼種子 (numpy.ndarray(dtype=uint8), shape=(n_seeds, seed_length))
+    :param packed_reference: pack_scan_reference 打包的參考基因組，使用索引時可為 None (tuple)
+    :param seed_length: 種子長度 (int)
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :param seed_index: build_seed_index 建立的索引，提供時以索引取代線性掃描 (tuple)
+    :return: 每個匹配的種子索引與位置 (tuple of numpy.ndarray(dtype=int64))
+    """
+    if seed_index is not None and seed_index[-1] != seed_length:
+        raise ValueError("Seed index was built for a different seed length.")
+    if seed_length > PLANE_BASES:
+        return tcam_lookup_bytes_all(seeds, *packed_reference, max_hamming_distance)
+    seed_vals, seed_masks = pack_seeds(seeds)
+    if seed_index is None and cuda is not None:
+        return cuda_lookup_all(seed_vals, seed_masks, *packed_reference, seed_length, max_hamming_distance)
+    if seed_index is None and njit is None:
+        return tcam_lookup_all(seed_vals, seed_masks, *packed_reference, max_hamming_distance)
+
+    if seed_index is not None:
+        deltas = neighbor_deltas(seed_length, max_hamming_distance)
+    else:
+        scanner = make_scan(seed_length)
+    seed_ids, positions = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for seed_id, (seed_val, seed_mask) in enumerate(zip(seed_vals, seed_masks)):
+        if seed_index is not None:
+            matches = index_lookup(seed_val, seed_mask, seed_index, deltas, max_hamming_distance)
+        else:
+            matches = scanner(*packed_reference, seed_val, seed_mask, max_hamming_distance)
+        seed_ids.append(np.full(len(matches), seed_id, dtype=np.int64))
+        positions.append(matches)
+    return np.concatenate(seed_ids), np.concatenate(positions)
+
+
+def replay_offsets(seed_ids, positions, offset_ptr, offsets):
+    """
+    將不重複種子的匹配依其在讀取中的每個位移各展開一次，換算為讀取起點。
+    :param seed_ids: 每個匹配的種子索引 (numpy.ndarray(dtype=int64))
+    :param positions: 每個匹配的位置 (numpy.ndarray(dtype=int64))
+    :param offset_ptr: generate_seeds 回傳的位移起訖 (numpy.ndarray(dtype=int64))
+    :param offsets: generate_seeds 回傳的位移 (numpy.ndarray(dtype=int64))
+    :return: 讀取起點，不含早於參考基因組開頭者 (numpy.ndarray(dtype=int64))
+    """
+    # 第 t 個位移為 offsets[offset_ptr[seed_id] + t]
+    repeats = offset_ptr[seed_ids + 1] - offset_ptr[seed_ids]
+    first = np.repeat(offset_ptr[seed_ids] - (np.cumsum(repeats) - repeats), repeats)
+    starts = np.repeat(positions, repeats) - offsets[first + np.arange(len(first))]
+    # 讀取起點早於參考基因組開頭的匹配不對應任何完整的比對位置，直接捨棄，
+    # 以免不同位移的匹配全部擠進第 0 個投票區域
+    return starts[starts >= 0]
+
+
+def lookup_seeds(read, packed_reference, seed_length, max_hamming_distance, seed_index=None):
+    """
+    對讀取序列的所有種子執行 TCAM 查找。
+    相同的種子只查找一次，匹配位置再依種子在讀取中的位移換算為讀取起點，
+    使同一處比對的所有種子投票落在同一區域。
+    :param read: 已編碼的基因讀取數據 (numpy.ndarray(dtype=uint8))
+    :param packed_reference: pack_scan_reference 打包的參考基因組，使用索引時可為 None (tuple)
+    :param seed_length: 種子長度 (int)
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :param seed_index: build_seed_index 建立的索引，提供時以索引取代線性掃描 (tuple)
+    :return: 所有種子匹配所對應的讀取起點 (numpy.ndarray(dtype=int64))
+    """
+    seeds, offset_ptr, offsets = generate_seeds(read, seed_length)
+    seed_ids, positions = scan_seeds(seeds, packed_reference, seed_length, max_hamming_distance, seed_index)
+    return replay_offsets(seed_ids, positions, offset_ptr, offsets)
+
+
+# 工作行程所負責的參考基因組分段：(共享記憶體, 分段起點, pack_scan_reference 打包結果)
+worker_shard = None
+
+
+def init_shard_worker(shm_name, reference_length, start, stop, seed_length):
+    """
+    工作行程的初始化：自共享記憶體取出負責的參考基因組分段並打包一次，之後每筆讀取都直接沿用。
+    各行程已分別負責一段參考基因組，Numba 只使用單一執行緒以免搶用核心。
+    :param shm_name: 存放已編碼參考基因組的共享記憶體名稱 (string)
+    :param reference_length: 參考基因組長度 (int)
+    :param start: 本段第一個視窗的起點 (int)
+    :param stop: 本段最後一個視窗的起點加 1 (int)
     :param seed_length: 種子長度 (int)
-    :return: 種子列表 (list of strings)
     """
-    seeds = []
-    for i in range(len(read) - seed_length + 1):
-        seeds.append(read[i:i + seed_length])
-    return seeds
+    global worker_shard
+    if njit is not None:
+        set_num_threads(1)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    reference = np.ndarray((reference_length,), dtype=np.uint8, buffer=shm.buf)
+    # 相鄰段重疊 seed_length - 1 個鹼基，使跨越分段邊界的視窗不會遺漏
+    shard = reference[start:stop + seed_length - 1]
+    # 長種子的打包結果是指向共享記憶體的 view，因此保留 shm 直到行程結束
+    worker_shard = (shm, start, pack_scan_reference(shard, seed_length))
 
 
-def tcam_lookup(seed, reference, max_hamming_distance):
+def scan_shard(seeds, seed_length, max_hamming_distance):
     """
-    模擬 TCAM 查找過程，支持近似匹配。
-    :param seed: 待查找的種子 (string)
-    :param reference: 參考基因組 (string)
+    在工作行程中以 init_shard_worker 打包好的分段執行 TCAM 掃描。
+    :param seeds: 不重複的已編碼種子 (numpy.ndarray(dtype=uint8), shape=(n_seeds, seed_length))
+    :param seed_length: 種子長度 (int)
     :param max_hamming_distance: 最大 Hamming 距離 (int)
-    :return: 匹配位置列表 (list of int)
+    :return: 每個匹配的種子索引與在整個參考基因組中的位置 (tuple of numpy.ndarray(dtype=int64))
     """
-    matches = []
-    for i in range(len(reference) - len(seed) + 1):
-        window = reference[i:i + len(seed)]
-        # 計算 Hamming 距離
-        mismatches = sum(1 for a, b in zip(seed, window) if a != b)
-        if mismatches <= max_hamming_distance:
-            matches.append(i)
-    return matches
+    _, start, packed_shard = worker_shard
+    seed_ids, positions = scan_seeds(seeds, packed_shard, seed_length, max_hamming_distance)
+    return seed_ids, positions + start
+
+
+def shard_reference(reference, seed_length, workers):
+    """
+    將已編碼的參考基因組複製到共享記憶體一次，並為每個分段啟動一個常駐的工作行程。
+    回傳值可在多筆讀取間重複傳給 fsva，用畢須以 close_sharded_reference 釋放。
+    :param reference: 已編碼的參考基因組 (numpy.ndarray(dtype=uint8))
+    :param seed_length: 種子長度 (int)
+    :param workers: 工作行程數 (int)
+    :return: (每個分段的 executor, 共享記憶體, 種子長度) (tuple)
+    """
+    n_windows = max(len(reference) - seed_length + 1, 0)
+    bounds = np.linspace(0, n_windows, workers + 1).astype(np.int64).tolist()
+
+    shm = shared_memory.SharedMemory(create=True, size=max(len(reference), 1))
+    np.ndarray((len(reference),), dtype=np.uint8, buffer=shm.buf)[:] = reference
+    # 每個分段一個專屬行程，分段在行程初始化時打包；Numba 的執行緒池在 fork 後不可靠，故以 spawn 啟動
+    executors = [ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn'),
+                                     initializer=init_shard_worker,
+                                     initargs=(shm.name, len(reference), start, stop, seed_length))
+                 for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+    return executors, shm, seed_length
+
+
+def close_sharded_reference(sharded_reference):
+    """
+    結束 shard_reference 啟動的工作行程並釋放共享記憶體。
+    :param sharded_reference: shard_reference 的回傳值 (tuple)
+    """
+    executors, shm, _ = sharded_reference
+    try:
+        for executor in executors:
+            executor.shutdown()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def sharded_lookup_seeds(read, sharded_reference, seed_length, max_hamming_distance):
+    """
+    以 shard_reference 的常駐工作行程平行執行 TCAM 掃描，結果與 lookup_seeds 相同。
+    :param read: 已編碼的基因讀取數據 (numpy.ndarray(dtype=uint8))
+    :param sharded_reference: shard_reference 的回傳值 (tuple)
+    :param seed_length: 種子長度 (int)
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :return: 所有種子匹配所對應的讀取起點 (numpy.ndarray(dtype=int64))
+    """
+    executors, _, shard_seed_length = sharded_reference
+    if shard_seed_length != seed_length:
+        raise ValueError("Sharded reference was packed for a different seed length.")
+    seeds, offset_ptr, offsets = generate_seeds(read, seed_length)
+    futures = [executor.submit(scan_shard, seeds, seed_length, max_hamming_distance) for executor in executors]
+    shards = [future.result() for future in futures]
+
+    seed_ids = np.concatenate([np.empty(0, dtype=np.int64)] + [ids for ids, _ in shards])
+    positions = np.concatenate([np.empty(0, dtype=np.int64)] + [pos for _, pos in shards])
+    return replay_offsets(seed_ids, positions, offset_ptr, offsets)
+
+
+def scan_and_vote(read, packed_reference, seed_length, max_hamming_distance, locality_size):
+    """
+    以 Cython 的 scan_matches 在 C 層級完成所有不重複種子的 TCAM 掃描，換算為讀取起點後投票。
+    輸出緩衝區只記錄每個不重複種子的匹配，不足時加倍，並自用盡時的種子繼續掃描，不重新掃描整個參考基因組。
+    :param read: 已編碼的基因讀取數據 (numpy.ndarray(dtype=uint8))
+    :param packed_reference: pack_reference 打包的參考基因組 (tuple)
+    :param seed_length: 種子長度 (int)
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :param locality_size: 投票區域大小 (int)
+    :return: 有票的投票區域編號 (遞增) 與其票數，格式同 voting (tuple of numpy.ndarray)
+    """
+    (reference,) = packed_reference
+    seeds, offset_ptr, offsets = generate_seeds(read, seed_length)
+    seed_ids = np.empty(MATCH_BUFFER_SIZE, dtype=np.int64)
+    positions = np.empty(MATCH_BUFFER_SIZE, dtype=np.int64)
+    next_seed, count = scan_matches(reference, seeds, 0, max_hamming_distance, seed_ids, positions, 0)
+    while next_seed < len(seeds):
+        seed_ids = np.concatenate((seed_ids[:count], np.empty(2 * len(seed_ids) - count, dtype=np.int64)))
+        positions = np.concatenate((positions[:count], np.empty(2 * len(positions) - count, dtype=np.int64)))
+        next_seed, count = scan_matches(reference, seeds, next_seed, max_hamming_distance, seed_ids, positions,
+                                        count)
+    return voting(replay_offsets(seed_ids[:count], positions[:count], offset_ptr, offsets), locality_size)
 
 
 def voting(matches, locality_size):
     """
-    根據種子匹配結果統計投票數。
-    :param matches: 匹配位置列表 (list of int)
+    根據種子匹配結果統計投票數，只回傳有票的投票區域。
+    匹配數相對於區域數較多時以 bincount 計數，否則排序後依區域邊界分組計數，
+    不必配置涵蓋整個參考基因組的計數陣列。
+    :param matches: 匹配位置陣列 (numpy.ndarray(dtype=int64))
     :param locality_size: 投票區域大小 (int)
-    :return: 投票計數字典 (dict of int -> int)
+    :return: 有票的投票區域編號 (遞增) 與其票數，區域 i 從 i * locality_size 開始 (tuple of numpy.ndarray(dtype=int64))
     """
-    vote_counts = defaultdict(int)
-    for match in matches:
-        locality_start = (match // locality_size) * locality_size
-        vote_counts[locality_start] += 1
-    return vote_counts
+    if len(matches) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    localities = matches // locality_size
+    if len(localities) >= localities.max() + 1:
+        vote_counts = np.bincount(localities)
+        occupied = np.flatnonzero(vote_counts)
+        return occupied, vote_counts[occupied]
+    localities.sort()
+    edges = np.concatenate(([0], np.flatnonzero(np.diff(localities)) + 1, [len(localities)]))
+    return localities[edges[:-1]], np.diff(edges)
 
 
-def filtering(vote_counts, vote_threshold):
+def filtering(votes, vote_threshold, locality_size):
     """
     根據投票數過濾候選位置。
-    :param vote_counts: 投票計數字典 (dict of int -> int)
+    :param votes: voting 統計的投票區域編號與票數 (tuple of numpy.ndarray)
     :param vote_threshold: 投票數門檻 (int)
-    :return: 候選位置列表 (list of int)
+    :param locality_size: 投票區域大小 (int)
+    :return: 候選位置列表，依位置遞增排列 (list of int)
+    """
+    localities, vote_counts = votes
+    return (localities[vote_counts >= vote_threshold] * locality_size).tolist()
+
+
+def create_query_profile(query):
+    """
+    建立 query profile：預先算好每個參考字元與讀取序列各位置的計分，供同一筆讀取的所有候選位置共用。
+    :param query: 待比對的序列 (string)
+    :return: 計分表，第 c 列為參考字元 c 對讀取序列各位置的分數 (numpy.ndarray(dtype=int32), shape=(256, len(query)))
     """
-    candidates = [position for position, count in vote_counts.items() if count >= vote_threshold]
-    return candidates
+    query_arr = np.frombuffer(query.encode('ascii'), dtype=np.uint8)
+    symbols = np.arange(256, dtype=np.uint8)[:, None]
+    return np.where(symbols == query_arr, MATCH_SCORE, MISMATCH_SCORE).astype(np.int32)
 
 
-def smith_waterman(query, reference):
+if njit is not None:
+    @njit(cache=True)
+    def smith_waterman_rows(query_profile, reference):
+        """
+        以 Numba 編譯的 Smith-Waterman：逐一處理參考字元，只保留兩列長度 m + 1 的 DP，
+        最大分數在更新格子時一併取得。
+        :param query_profile: create_query_profile 建立的計分表 (numpy.ndarray(dtype=int32), shape=(256, m))
+        :param reference: 參考片段 (numpy.ndarray(dtype=uint8))
+        :return: 最佳比對分數 (int)
+        """
+        m = query_profile.shape[1]
+        prev = np.zeros(m + 1, dtype=np.int32)
+        current = np.zeros(m + 1, dtype=np.int32)
+        max_score = 0
+        for j in range(len(reference)):
+            scores = query_profile[reference[j]]
+            for i in range(1, m + 1):
+                cell = max(prev[i - 1] + scores[i - 1], prev[i] - GAP_PENALTY, current[i - 1] - GAP_PENALTY, 0)
+                current[i] = cell
+                if cell > max_score:
+                    max_score = cell
+            prev, current = current, prev
+        return max_score
+
+
+def smith_waterman(query, reference, query_profile=None):
     """
-    使用 Smith-Waterman 演算法執行局部比對。
+    使用 Smith-Waterman 演算法執行局部比對，有 Numba 時使用 smith_waterman_rows。
+    否則利用同一條反對角線上的格子彼此獨立，沿反對角線以 NumPy 向量運算一次更新整條，
+    並且只保留前兩條反對角線。
     :param query: 待比對的序列 (string)
-    :param reference: 參考基因組 (string)
+    :param reference: 參考基因組，可為字串或 ASCII 位元組陣列 (string or numpy.ndarray(dtype=uint8))
+    :param query_profile: create_query_profile 建立的計分表，未提供時即時建立 (numpy.ndarray)
     :return: 最佳比對分數 (int)
     """
     m, n = len(query), len(reference)
-    dp = [[0] * (n + 1) for _ in range(m + 1)]
+    if m == 0 or n == 0:
+        return 0
+    if query_profile is None:
+        query_profile = create_query_profile(query)
+    if isinstance(reference, str):
+        reference = np.frombuffer(reference.encode('ascii'), dtype=np.uint8)
+    if njit is not None:
+        return int(smith_waterman_rows(query_profile, reference))
+
+    query_index = np.arange(m)
+    # 反轉參考序列，使反對角線上的參考字元成為連續區段
+    reversed_reference = reference[::-1]
+
+    # 以列索引 i 存放反對角線 d = i + j 上的格子 dp[i][d - i]
+    prev_prev = np.zeros(m + 1, dtype=np.int32)
+    prev = np.zeros(m + 1, dtype=np.int32)
     max_score = 0
 
-    for i in range(1, m + 1):
-        for j in range(1, n + 1):
-            match = dp[i - 1][j - 1] + (2 if query[i - 1] == reference[j - 1] else -1)
-            delete = dp[i - 1][j] - 1
-            insert = dp[i][j - 1] - 1
-            dp[i][j] = max(0, match, delete, insert)
-            max_score = max(max_score, dp[i][j])
+    for d in range(2, m + n + 1):
+        lo, hi = max(1, d - n), min(m, d - 1)
+        current = np.zeros(m + 1, dtype=np.int32)
+        scores = query_profile[reversed_reference[n - d + lo:n - d + hi + 1], query_index[lo - 1:hi]]
+        match = prev_prev[lo - 1:hi] + scores
+        delete = prev[lo - 1:hi] - GAP_PENALTY
+        insert = prev[lo:hi + 1] - GAP_PENALTY
+        cells = np.maximum(np.maximum(match, delete), np.maximum(insert, 0))
+        current[lo:hi + 1] = cells
+        max_score = max(max_score, int(cells.max()))
+        prev_prev, prev = prev, current
 
     return max_score
 
 
+def alignment_upper_bounds(read, targets, target_lengths):
+    """
+    計算各候選片段 Smith-Waterman 分數的上界，只需計數而不必比對。
+    每個匹配最多得 MATCH_SCORE 分，且同一字元的匹配數不超過它在讀取與片段中出現次數的較小值，
+    不論比對中有多少 gap 皆成立。
+    :param read: 基因讀取數據 (string)
+    :param targets: 各候選位置的參考片段 (numpy.ndarray(dtype=uint8), shape=(n_candidates, len(read)))
+    :param target_lengths: 各參考片段的實際長度 (list of int)
+    :return: 分數上界 (numpy.ndarray(dtype=int64))
+    """
+    read_bytes = np.frombuffer(read.encode('ascii'), dtype=np.uint8)
+    # 超出參考基因組結尾而被截掉的部分不計
+    valid = np.arange(len(read)) < np.array(target_lengths, dtype=np.int64)[:, None]
+    matches = np.zeros(len(targets), dtype=np.int64)
+    for symbol, count in zip(*np.unique(read_bytes, return_counts=True)):
+        matches += np.minimum(((targets == symbol) & valid).sum(axis=1), count)
+    return MATCH_SCORE * matches
+
+
+def gather_segments(reference_bytes, starts, length):
+    """
+    以參考基因組的滑動視窗取出各起點的參考片段並轉為大寫，不需建立 (候選數, length) 的索引矩陣。
+    片段分批取出，每批的暫存陣列不超過 CHUNK_ELEMENTS 個位元組。
+    超出參考基因組結尾的部分補 0，只有結尾附近的起點需要另外補齊，不複製整個參考基因組。
+    :param reference_bytes: ASCII 參考基因組 (numpy.ndarray(dtype=uint8))
+    :param starts: 各片段的起點，皆小於參考基因組長度 (numpy.ndarray(dtype=int64))
+    :param length: 片段長度 (int)
+    :return: 各片段的大寫鹼基 (numpy.ndarray(dtype=uint8), shape=(len(starts), length))
+    """
+    segments = np.zeros((len(starts), length), dtype=np.uint8)
+    if length == 0:
+        return segments
+    # 起點在 full_windows 之前的片段完整落在參考基因組內，其餘取自補 0 的結尾
+    full_windows = max(len(reference_bytes) - length + 1, 0)
+    tail = np.zeros(len(reference_bytes) - full_windows + length, dtype=np.uint8)
+    tail[:len(reference_bytes) - full_windows] = reference_bytes[full_windows:]
+    tail_windows = sliding_window_view(tail, length)
+    rows = max(CHUNK_ELEMENTS // length, 1)
+    for first in range(0, len(starts), rows):
+        block_starts = starts[first:first + rows]
+        block = segments[first:first + rows]
+        full = block_starts < full_windows
+        if full.any():
+            block[full] = sliding_window_view(reference_bytes, length)[block_starts[full]]
+        if not full.all():
+            block[~full] = tail_windows[block_starts[~full] - full_windows]
+        block[:] = UPPERCASE_LOOKUP[block]
+    return segments
+
+
+# 最近一次以字串傳入的參考基因組及其 ASCII 位元組：(字串, numpy.ndarray(dtype=uint8))
+reference_bytes_cache = (None, None)
+
+
+def reference_as_bytes(reference):
+    """
+    取得參考基因組的 ASCII 位元組。bytes、mmap 等緩衝區直接以 numpy 檢視，不複製；
+    字串須編碼一次，結果保留至傳入另一個字串為止，同一字串在多筆讀取間不會重複複製。
+    :param reference: 參考基因組 (string or bytes-like)
+    :return: ASCII 參考基因組 (numpy.ndarray(dtype=uint8))
+    """
+    global reference_bytes_cache
+    if not isinstance(reference, str):
+        return np.frombuffer(reference, dtype=np.uint8)
+    if reference_bytes_cache[0] is not reference:
+        reference_bytes_cache = (reference, np.frombuffer(reference.encode('ascii'), dtype=np.uint8))
+    return reference_bytes_cache[1]
+
 
-def fsva(read, reference, seed_length, max_hamming_distance, locality_size, vote_threshold):
+def fsva(read, reference, seed_length, max_hamming_distance, locality_size, vote_threshold,
+         packed_reference=None, seed_index=None, sharded_reference=None, top_n=None):
     """
     完整的 Fast Seed-and-Vote Algorithm (FSVA)。
-    :param read: 基因讀取數據 (string)
-    :param reference: 參考基因組 (string)
+    :param read: 基因讀取數據，只能包含 ACGTN 與 IUPAC 模糊鹼基 (大小寫皆可)，模糊鹼基在種子查找時視為萬用字元 (string)
+    :param reference: 參考基因組，可為字串或 mmap 等 ASCII 緩衝區，可接受的字元同 read；
+                      緩衝區不需複製，字串則在第一次傳入時編碼一次 (string or bytes-like)
     :param seed_length: 種子長度 (int)
     :param max_hamming_distance: 最大 Hamming 距離 (int)
     :param locality_size: 投票區域大小 (int)
     :param vote_threshold: 投票數門檻 (int)
-    :return: 候選位置和其對應的匹配分數 (list of tuple)
+    :param packed_reference: pack_reference 預先打包的參考基因組，未提供時即時打包 (tuple)
+    :param seed_index: build_seed_index 建立的 k-mer 索引，提供時以索引取代 TCAM 線性掃描 (tuple)
+    :param sharded_reference: shard_reference 建立的分段參考基因組，提供時以多個行程平行掃描 (tuple)
+    :param top_n: 只回傳分數最高的 top_n 個候選位置，分數相同時取位置較前者，並略過不可能入選的比對 (int)
+    :return: 候選位置和其對應的匹配分數，依位置遞增排列 (list of tuple)
     """
-    seeds = generate_seeds(read, seed_length)
-    all_matches = []
-    for seed in seeds:
-        matches = tcam_lookup(seed, reference, max_hamming_distance)
-        all_matches.extend(matches)
-    
-    vote_counts = voting(all_matches, locality_size)
-    candidates = filtering(vote_counts, vote_threshold)
+    if top_n is not None and top_n < 1:
+        raise ValueError("top_n must be a positive integer.")
+
+    reference_bytes = reference_as_bytes(reference)
+    sharded = seed_index is None and sharded_reference is not None
+    if packed_reference is None and seed_index is None and not sharded:
+        packed_reference = pack_reference(encode_sequence(reference_bytes), seed_length)
+
+    encoded_read = encode_sequence(read)
+    if sharded:
+        all_matches = sharded_lookup_seeds(encoded_read, sharded_reference, seed_length, max_hamming_distance)
+        votes = voting(all_matches, locality_size)
+    elif seed_index is None and scan_matches is not None:
+        # Cython 實作在 C 層級掃描所有不重複的種子
+        votes = scan_and_vote(encoded_read, packed_reference, seed_length,
+                              max_hamming_distance, locality_size)
+    else:
+        all_matches = lookup_seeds(encoded_read, packed_reference, seed_length, max_hamming_distance,
+                                   seed_index)
+        votes = voting(all_matches, locality_size)
+    candidates = filtering(votes, vote_threshold, locality_size)
     
+    # 鹼基不分大小寫，比對分數也以大寫計算
+    read = read.upper()
+    # 所有候選位置都與同一筆讀取比對，query profile 只需建立一次
+    if parasail is not None:
+        query_profile = parasail.profile_create_16(read, SCORE_MATRIX)
+    else:
+        query_profile = create_query_profile(read)
+
+    # 一次取出所有候選位置的參考片段，超出參考基因組結尾的部分之後截掉
+    starts = np.array(candidates, dtype=np.int64)
+    targets = gather_segments(reference_bytes, starts, len(read))
+    target_lengths = np.clip(len(reference_bytes) - starts, 0, len(read)).tolist()
+
+    # 指定 top_n 時依分數上界由高到低比對，上界相同時維持位置遞增
+    if top_n is None:
+        order = range(len(candidates))
+    else:
+        upper_bounds = alignment_upper_bounds(read, targets, target_lengths)
+        order = np.argsort(-upper_bounds, kind='stable').tolist()
+        upper_bounds = upper_bounds.tolist()
+
     results = []
-    for candidate in tqdm(candidates):
-        query_segment = read
-        reference_segment = reference[candidate:candidate + len(read)]
-        score = smith_waterman(query_segment, reference_segment)
-        results.append((candidate, score))
-    
+    wide_profile = None
+    # 以 (分數, -位置) 為鍵的最小堆積，堆頂為目前前 top_n 名中最差者
+    top_scores = []
+    for index in tqdm(order):
+        candidate = candidates[index]
+        if top_n is not None and len(top_scores) == top_n and (upper_bounds[index], -candidate) < top_scores[0]:
+            # 之後的候選位置上界不會更高，都不可能再進入前 top_n 名
+            break
+        reference_segment = targets[index, :target_lengths[index]]
+        if parasail is not None:
+            # 線性 gap 下 open 等於 extend，striped 版本會低估分數，因此使用 scan 版本
+            result = parasail.sw_scan_profile_16(query_profile, reference_segment.tobytes(),
+                                                 GAP_PENALTY, GAP_PENALTY)
+            if result.saturated:
+                # 16-bit 分數溢位 (讀取長度約 16384 以上)，改以 32-bit 的 profile 重新比對
+                if wide_profile is None:
+                    wide_profile = parasail.profile_create_32(read, SCORE_MATRIX)
+                result = parasail.sw_scan_profile_32(wide_profile, reference_segment.tobytes(),
+                                                     GAP_PENALTY, GAP_PENALTY)
+            score = result.score
+        else:
+            score = smith_waterman(read, reference_segment, query_profile)
+        if top_n is None:
+            results.append((candidate, score))
+        elif len(top_scores) < top_n:
+            heapq.heappush(top_scores, (score, -candidate))
+        elif (score, -candidate) > top_scores[0]:
+            heapq.heapreplace(top_scores, (score, -candidate))
+
+    if top_n is not None:
+        results = sorted((-negative_candidate, score) for score, negative_candidate in top_scores)
     return results
 
 # 主程式執行
-with open('reference.txt', 'r', encoding='utf-8') as ref_file:
-    reference = ref_file.read().replace('\n', '')
-    # print(reference)
-    
+if __name__ == "__main__":
+    # reference.bin 為 strip_newlines.py 去除換行後的參考基因組，以 mmap 直接交給 encode_sequence
+    with open('reference.bin', 'rb') as ref_file, \
+            mmap.mmap(ref_file.fileno(), 0, access=mmap.ACCESS_READ) as reference:
+
+        with open('971_200.txt', 'r', encoding='utf-8') as read_file:
+            read = read_file.read().replace('\n', '')
 
-with open('971_200.txt', 'r', encoding='utf-8') as read_file:
-    read = read_file.read().replace('\n', '')
+        seed_length = 4
+        max_hamming_distance = 1
+        locality_size = 4
+        vote_threshold = 2
 
-seed_length = 4
-max_hamming_distance = 1
-locality_size = 4
-vote_threshold = 2
+        # 參考基因組的 k-mer 索引只需建立一次，可供多筆讀取重複使用
+        seed_index = build_seed_index(encode_sequence(reference), seed_length)
 
-# 執行 FSVA
-results = fsva(read, reference, seed_length, max_hamming_distance, locality_size, vote_threshold)
+        # 執行 FSVA，只需要分數最高的三個結果
+        results = fsva(read, reference, seed_length, max_hamming_distance, locality_size, vote_threshold,
+                       seed_index=seed_index, top_n=3)
 
-# 根據分數排序，取分數最高的三個結果
-top_results = sorted(results, key=lambda x: x[1], reverse=True)[:3]
+    # 根據分數排序，取分數最高的三個結果
+    top_results = sorted(results, key=lambda x: x[1], reverse=True)[:3]
 
-# 輸出結果
-print("分數最高的三個匹配位置與分數:")
-for position, score in top_results:
-    print(f"位置: {position}, 分數: {score}")
\ No newline at end of file
+    # 輸出結果
+    print("分數最高的三個匹配位置與分數:")
+    for position, score in top_results:
+        print(f"位置: {position}, 分數: {score}")
@@ -1,28 +1,24 @@
+import mmap
 import random
 
-def extract_content(base, length, output_file):
+def extract_content(reference, base, length, output_file):
     try:
-        # 讀取 reference.txt
-        with open('reference.txt', 'r', encoding='utf-8') as ref_file:
-            content = ref_file.read()
-
+        # reference 為 reference.txt 的 mmap，擷取時只複製需要的片段
         # 確保 base 和 length 不超過內容長度
-        if base < 0 or base >= len(content):
+        if base < 0 or base >= len(reference):
             raise ValueError("Base index is out of bounds.")
 
         if length < 0:
             raise ValueError("Length must be a non-negative integer.")
 
-        extracted = content[base:base + length]
+        extracted = reference[base:base + length]
 
         # 將擷取的內容寫入指定檔案
-        with open(output_file, 'w', encoding='utf-8') as read_file:
+        with open(output_file, 'wb') as read_file:
             read_file.write(extracted)
 
         print(f"Content extracted successfully and saved to {output_file}.")
 
-    except FileNotFoundError:
-        print("Error: 'reference.txt' not found in the current directory.")
     except ValueError as ve:
         print(f"Error: {ve}")
     except Exception as e:
@@ -34,10 +30,15 @@ if __name__ == "__main__":
         random_bases = [random.randint(0, 1000) for _ in range(10)]
         lengths = [10000] * 10 + [200] * 10
 
-        for i, base in enumerate(random_bases * 2):
-            length = lengths[i]
-            output_file = f"{base}_{length}.txt"
-            extract_content(base, length, output_file)
+        # reference.txt 只開啟一次並以 mmap 對應，每次擷取不再重新讀取整個檔案
+        with open('reference.txt', 'rb') as ref_file:
+            with mmap.mmap(ref_file.fileno(), 0, access=mmap.ACCESS_READ) as reference:
+                for i, base in enumerate(random_bases * 2):
+                    length = lengths[i]
+                    output_file = f"{base}_{length}.txt"
+                    extract_content(reference, base, length, output_file)
 
+    except FileNotFoundError:
+        print("Error: 'reference.txt' not found in the current directory.")
     except ValueError:
         print("An error occurred during the extraction process.")
@@ -0,0 +1,19 @@
+CHUNK_SIZE = 1 << 20
+
+def strip_newlines(input_file, output_file):
+    try:
+        # 分段讀取並去除換行，整個檔案不需一次載入記憶體
+        with open(input_file, 'rb') as src, open(output_file, 'wb') as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                dst.write(chunk.replace(b'\r', b'').replace(b'\n', b''))
+
+        print(f"Newlines removed successfully and saved to {output_file}.")
+
+    except FileNotFoundError:
+        print(f"Error: '{input_file}' not found in the current directory.")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+
+if __name__ == "__main__":
+    # 參考基因組只需預處理一次，fsva.py 之後直接以 mmap 讀取 reference.bin
+    strip_newlines('reference.txt', 'reference.bin')
@@ -0,0 +1,63 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+以 Cython 實作的 TCAM 掃描，整個流程在 C 層級完成，不產生任何 Python 物件。
+由 fsva.py 透過 pyximport 即時編譯，編譯參數見 tcam_scan.pyxbld。
+"""
+from libc.stdint cimport uint8_t, int64_t
+
+
+cdef Py_ssize_t tcam_scan_all(const uint8_t* ref, Py_ssize_t rlen, const uint8_t* seeds, Py_ssize_t first_seed,
+                              Py_ssize_t nseeds, int k, int max_hd, int64_t* seed_ids, int64_t* positions,
+                              Py_ssize_t capacity, Py_ssize_t* count) noexcept nogil:
+    """
+    自 first_seed 起逐一以種子掃描參考基因組，匹配時寫入種子索引與位置，從 count 指向的位置接續寫入。
+    編碼為 one-hot，兩鹼基的 AND 為 0 即不匹配，萬用字元因此不需特別處理。
+    緩衝區在某個種子掃描途中用盡時，捨棄該種子已寫入的匹配並回傳其索引，擴充緩衝區後可由此繼續；
+    全部完成時回傳 nseeds。count 更新為已完整寫入的匹配數。
+    """
+    cdef Py_ssize_t s, i
+    cdef Py_ssize_t total = count[0]
+    cdef int j, mismatches
+    cdef const uint8_t* seed
+
+    for s in range(first_seed, nseeds):
+        seed = seeds + s * k
+        for i in range(rlen - k + 1):
+            mismatches = 0
+            for j in range(k):
+                if (seed[j] & ref[i + j]) == 0:
+                    mismatches += 1
+                    if mismatches > max_hd:
+                        break
+            if mismatches > max_hd:
+                continue
+            if total == capacity:
+                return s
+            seed_ids[total] = s
+            positions[total] = i
+            total += 1
+        count[0] = total
+    return nseeds
+
+
+def scan_matches(const uint8_t[::1] reference, const uint8_t[:, ::1] seeds, Py_ssize_t first_seed,
+                 int max_hamming_distance, int64_t[::1] seed_ids, int64_t[::1] positions, Py_ssize_t count):
+    """
+    tcam_scan_all 的 Python 介面，掃描期間釋放 GIL。
+    :param reference: 已編碼的參考基因組 (numpy.ndarray(dtype=uint8))
+    :param seeds: 不重複的已編碼種子 (numpy.ndarray(dtype=uint8), shape=(n_seeds, seed_length))
+    :param first_seed: 開始掃描的種子索引 (int)
+    :param max_hamming_distance: 最大 Hamming 距離 (int)
+    :param seed_ids: 輸出緩衝區，寫入每個匹配的種子索引，長度至少為 1 (numpy.ndarray(dtype=int64))
+    :param positions: 輸出緩衝區，寫入每個匹配的位置，長度與 seed_ids 相同 (numpy.ndarray(dtype=int64))
+    :param count: 緩衝區中已寫入的匹配數，新的匹配接在其後 (int)
+    :return: (下一個待掃描的種子索引，等於種子數時表示完成, 已寫入的匹配數) (tuple of int)
+    """
+    cdef Py_ssize_t next_seed
+    if seeds.shape[0] == 0 or reference.shape[0] < seeds.shape[1]:
+        return seeds.shape[0], count
+    with nogil:
+        next_seed = tcam_scan_all(&reference[0], reference.shape[0], &seeds[0, 0], first_seed, seeds.shape[0],
+                                  <int>seeds.shape[1], max_hamming_distance, &seed_ids[0], &positions[0],
+                                  seed_ids.shape[0], &count)
+    return next_seed, count
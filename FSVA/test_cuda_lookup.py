@@ -0,0 +1,69 @@
+"""
+以 Numba 的 CUDA 模擬器驗證 cuda_lookup_all 與 NumPy 位元平面實作的結果一致，不需要實體 GPU。
+模擬器必須在匯入 Numba 之前啟用，因此本檔案需單獨執行：python -m pytest FSVA/test_cuda_lookup.py
+"""
+import os
+import random
+
+os.environ.setdefault('NUMBA_ENABLE_CUDASIM', '1')
+
+import numpy as np
+import pytest
+
+fsva = pytest.importorskip('fsva')
+if fsva.cuda is None:
+    pytest.skip("numba.cuda is not available", allow_module_level=True)
+
+
+def random_sequence(rng, length, wildcard_rate=0.0):
+    return ''.join(rng.choice('ACGTN' if rng.random() < wildcard_rate else 'ACGT') for _ in range(length))
+
+
+def sorted_pairs(seed_ids, positions):
+    return sorted(zip(seed_ids.tolist(), positions.tolist()))
+
+
+@pytest.mark.parametrize('seed_length', [1, 4, 7, 32])
+@pytest.mark.parametrize('max_hamming_distance', [1, 3])
+def test_cuda_lookup_matches_bit_planes(seed_length, max_hamming_distance):
+    rng = random.Random(seed_length * 10 + max_hamming_distance)
+    reference = fsva.encode_sequence(random_sequence(rng, 150, wildcard_rate=0.05))
+    read = fsva.encode_sequence(random_sequence(rng, 50))
+    seeds, _, _ = fsva.generate_seeds(read, seed_length)
+    seed_vals, seed_masks = fsva.pack_seeds(seeds)
+
+    expected = fsva.tcam_lookup_all(seed_vals, seed_masks, *fsva.pack_bit_planes(reference, seed_length),
+                                    max_hamming_distance)
+    seed_ids, positions = fsva.scan_seeds(seeds, fsva.pack_scan_reference(reference, seed_length), seed_length,
+                                          max_hamming_distance)
+    # 結果已排序，與 CPU 實作的順序一致
+    assert list(zip(seed_ids.tolist(), positions.tolist())) == sorted_pairs(*expected)
+
+
+def test_cuda_lookup_grows_output_buffer(monkeypatch):
+    monkeypatch.setattr(fsva, 'MATCH_BUFFER_SIZE', 1)
+    rng = random.Random(16)
+    reference = fsva.encode_sequence(random_sequence(rng, 150))
+    seeds, _, _ = fsva.generate_seeds(fsva.encode_sequence(random_sequence(rng, 50)), 4)
+    seed_vals, seed_masks = fsva.pack_seeds(seeds)
+
+    expected = fsva.tcam_lookup_all(seed_vals, seed_masks, *fsva.pack_bit_planes(reference, 4), 2)
+    assert len(expected[0]) > 1
+    packed_reference = fsva.pack_scan_reference(reference, 4)
+    got = fsva.cuda_lookup_all(seed_vals, seed_masks, *packed_reference, 4, 2)
+    assert sorted_pairs(*got) == sorted_pairs(*expected)
+    # 擴充後的緩衝區保留在打包結果中，之後的呼叫不需再擴充
+    grown = list(packed_reference[-1])
+    assert len(grown[0]) >= len(expected[0])
+    got = fsva.cuda_lookup_all(seed_vals, seed_masks, *packed_reference, 4, 2)
+    assert sorted_pairs(*got) == sorted_pairs(*expected)
+    assert all(buffer is kept for buffer, kept in zip(packed_reference[-1], grown))
+
+
+def test_cuda_lookup_empty_inputs():
+    reference = fsva.encode_sequence('ACGT')
+    seeds = np.empty((0, 8), dtype=np.uint8)
+    seed_vals, seed_masks = fsva.pack_seeds(seeds)
+    seed_ids, positions = fsva.cuda_lookup_all(seed_vals, seed_masks, *fsva.pack_scan_reference(reference, 8),
+                                               8, 1)
+    assert len(seed_ids) == 0 and len(positions) == 0
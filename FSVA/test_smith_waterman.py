@@ -0,0 +1,38 @@
+"""
+驗證 parasail 與 Numba、NumPy 的 Smith-Waterman 實作對 encode_sequence 接受的所有字元計分一致。
+"""
+import random
+
+import pytest
+
+fsva = pytest.importorskip('fsva')
+
+
+def random_sequence(rng, length, alphabet):
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def fallback_scores(monkeypatch, query, reference):
+    scores = [fsva.smith_waterman(query, reference)]
+    # 停用 Numba 以改用 NumPy 反對角線實作
+    monkeypatch.setattr(fsva, 'njit', None)
+    scores.append(fsva.smith_waterman(query, reference))
+    return scores
+
+
+def test_iupac_example(monkeypatch):
+    query, reference = 'ARTGRCGCCCARYGT', 'GRGYARGRCRRRG'
+    assert fallback_scores(monkeypatch, query, reference) == [9, 9]
+
+
+@pytest.mark.parametrize('alphabet', ['ACGTRY', fsva.SCORE_ALPHABET])
+def test_parasail_matches_fallback_on_iupac(monkeypatch, alphabet):
+    parasail = pytest.importorskip('parasail')
+    rng = random.Random(len(alphabet))
+    for _ in range(50):
+        query = random_sequence(rng, rng.randint(1, 40), alphabet)
+        reference = random_sequence(rng, rng.randint(1, 40), alphabet)
+        profile = parasail.profile_create_16(query, fsva.SCORE_MATRIX)
+        expected = parasail.sw_scan_profile_16(profile, reference, fsva.GAP_PENALTY, fsva.GAP_PENALTY).score
+        with monkeypatch.context() as patch:
+            assert fallback_scores(patch, query, reference) == [expected, expected]